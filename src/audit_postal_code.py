@@ -3,10 +3,10 @@
 - The update_zip function actually fixes the postal codes.
 """
 
-import xml.etree.cElementTree as ET
 from collections import defaultdict
 import re
 import pprint
+from osm_cache import iter_elements
 
 # osm file
 OSMFILE = "las-vegas_nevada.osm"
@@ -29,15 +29,13 @@ def is_zip(elem):
     return (elem.attrib['k'] == "addr:postcode")
 
 # Returning 5 digits of postcode as a key and their values in dictionary
+# (parsed elements are cached by osm_cache, so reruns skip the XML parsing)
 def zip_audit(osmfile):
-    osm_file = open(osmfile, "r")
     zip_types = defaultdict(set)
-    for event, elem in ET.iterparse(osm_file, events=("start",)):
-        if elem.tag == "node" or elem.tag == "way":
-            for tag in elem.iter("tag"):
-                if is_zip(tag):
-                    audit_zip_type(zip_types, tag.attrib['v'])
-    osm_file.close()
+    for elem in iter_elements(osmfile, tags=('node', 'way')):
+        for tag in elem.iter("tag"):
+            if is_zip(tag):
+                audit_zip_type(zip_types, tag.attrib['v'])
     return zip_types
 
 # Updating each postal code to a better form
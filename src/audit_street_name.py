@@ -5,10 +5,10 @@
 - Using the update_name function, to actually fix the street name.
     The function takes a string with street name as an argument and return the fixed name.
 """
-import xml.etree.cElementTree as ET
 from collections import defaultdict
 import re
 import pprint
+from osm_cache import iter_elements
 
 # osm file
 OSMFILE = "las-vegas_nevada.osm"
@@ -56,16 +56,13 @@ def is_street_name(elem):
     return (elem.attrib['k'] == "addr:street")
 
 # Returning dictionary of uncleaned street names and their values
+# (parsed elements are cached by osm_cache, so reruns skip the XML parsing)
 def audit(osmfile):
-    osm_file = open(osmfile, "r")
     street_types = defaultdict(set)
-    for event, elem in ET.iterparse(osm_file, events=("start",)):
-
-        if elem.tag == "node" or elem.tag == "way":
-            for tag in elem.iter("tag"):
-                if is_street_name(tag):
-                    audit_street_type(street_types, tag.attrib['v'])
-    osm_file.close()
+    for elem in iter_elements(osmfile, tags=('node', 'way')):
+        for tag in elem.iter("tag"):
+            if is_street_name(tag):
+                audit_street_type(street_types, tag.attrib['v'])
     return street_types
 
 # Updating street type to a better name in the mapping list
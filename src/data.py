@@ -86,6 +86,17 @@ The function takes an iterparse Element object as input and return a dictionary.
                'key': 'building_id',
                'type': 'chicago',
                'value': '366409'}]}
+
+### A "relation" element is shaped like a way, with its members in place of the way nodes:
+
+{'relation': {'id': 170117, 'user': ..., 'uid': ..., 'version': ..., 'timestamp': ..., 'changeset': ...},
+ 'relation_members': [{'id': 170117, 'type': 'way', 'ref': 29084862, 'role': 'outer', 'position': 0},
+                      ...],
+ 'relation_tags': [{'id': 170117, 'key': 'type', 'type': 'regular', 'value': 'boundary'},
+                   ...]}
+
+The members are shaped lazily while they are written (see RelationMembers), so relations
+with tens of thousands of members don't need a list of them in memory.
 """
 
 # Importing libraries
@@ -95,8 +106,22 @@ import re
 import pprint
 import csv
 import codecs
+import cStringIO
+import json
+import math
+import os
+import sys
+from multiprocessing.pool import ThreadPool
+from array import array
+from bisect import bisect_left
+import threading
+import time
+import Queue
 import cerberus
 import schema
+from street_normalizer import StreetNormalizer
+from osm_cache import iter_elements
+from osm_writer import OsmWriter
 
 # ================================================== #
 #                  Data Cleaning                     #
@@ -150,28 +175,20 @@ def is_street_name(elem):
     return (elem.attrib['k'] == "addr:street")
 
 # Returning dictionary of uncleaned street names and their values
+# (parsed elements are cached by osm_cache, so reruns skip the XML parsing)
 def audit(osmfile):
-    osm_file = open(osmfile, "r")
     street_types = defaultdict(set)
-    for event, elem in ET.iterparse(osm_file, events=("start",)):
-
-        if elem.tag == "node" or elem.tag == "way":
-            for tag in elem.iter("tag"):
-                if is_street_name(tag):
-                    audit_street_type(street_types, tag.attrib['v'])
-    osm_file.close()
+    for elem in iter_elements(osmfile, tags=('node', 'way')):
+        for tag in elem.iter("tag"):
+            if is_street_name(tag):
+                audit_street_type(street_types, tag.attrib['v'])
     return street_types
 
 cleaned = "cleaned.osm"
 
-# Updating street type to a better name in the mapping list
-def update_name(name, mapping, street_type_re):
-    m = street_type_re.search(name)
-    if m:
-        st_type = m.group()
-        if st_type in mapping:
-            name = re.sub(street_type_re, mapping[st_type], name)
-    return name
+# Updating street types to better names in the mapping list. Built once from the tables
+# above; unlike a regex on the last word it also handles "Blvd Ste 100" and "Rd N"
+street_name_normalizer = StreetNormalizer(mapping, expected)
 
 #######   Helper function  #######
 # Getting elements from OSM file
@@ -188,15 +205,14 @@ def get_element(osm_file, tags=('node', 'way', 'relation')):
 
 # Replacing abbreviations of street types and saving the changes in a new file
 def modify_street(old_file, new_file):
-    with open(new_file, 'wb') as output:
-        output.write('<?xml version="1.0" encoding="UTF-8"?>\n')
-        output.write('<osm>\n  ')
-        for i, element in enumerate(get_element(old_file)):
+    with OsmWriter(new_file) as writer:
+        for element in writer.copy_from(old_file):
             for tag in element.iter("tag"):
                 if is_street_name(tag):
-                    tag.set('v',update_name(tag.attrib['v'], mapping, street_type_re))
-            output.write(ET.tostring(element, encoding='utf-8'))
-        output.write('</osm>')
+                    better_name = street_name_normalizer.update_name(tag.attrib['v'])
+                    if better_name != tag.attrib['v']:
+                        tag.set('v', better_name)
+            writer.write(element)
 
 # Modifying osm file
 modify_street(OSMFILE, cleaned)
@@ -221,15 +237,13 @@ def is_zip(elem):
     return (elem.attrib['k'] == "addr:postcode")
 
 # Returning 5 digits of postcode as a key and their values in dictionary
+# (parsed elements are cached by osm_cache, so reruns skip the XML parsing)
 def zip_audit(osmfile):
-    osm_file = open(osmfile, "r")
     zip_types = defaultdict(set)
-    for event, elem in ET.iterparse(osm_file, events=("start",)):
-        if elem.tag == "node" or elem.tag == "way":
-            for tag in elem.iter("tag"):
-                if is_zip(tag):
-                    audit_zip_type(zip_types, tag.attrib['v'])
-    osm_file.close()
+    for elem in iter_elements(osmfile, tags=('node', 'way')):
+        for tag in elem.iter("tag"):
+            if is_zip(tag):
+                audit_zip_type(zip_types, tag.attrib['v'])
     return zip_types
 
 # Updating each postal code to a better form
@@ -244,15 +258,14 @@ cleaned2 = "cleaned2.osm"
 
 # This function replace wrong postcode in osm file
 def modify_zip(old_file, new_file):
-    with open(new_file, 'wb') as output:
-        output.write('<?xml version="1.0" encoding="UTF-8"?>\n')
-        output.write('<osm>\n  ')
-        for i, element in enumerate(get_element(old_file)):
+    with OsmWriter(new_file) as writer:
+        for element in writer.copy_from(old_file):
             for tag in element.iter("tag"):
                 if is_zip(tag):
-                    tag.set('v',update_zip(tag.attrib['v']))
-            output.write(ET.tostring(element, encoding='utf-8'))
-        output.write('</osm>')
+                    better_zip = update_zip(tag.attrib['v'])
+                    if better_zip != tag.attrib['v']:
+                        tag.set('v', better_zip)
+            writer.write(element)
 
 # Modifying osm file
 modify_zip(cleaned, cleaned2)
@@ -268,6 +281,12 @@ NODE_TAGS_PATH = "nodes_tags.csv"
 WAYS_PATH = "ways.csv"
 WAY_NODES_PATH = "ways_nodes.csv"
 WAY_TAGS_PATH = "ways_tags.csv"
+RELATIONS_PATH = "relations.csv"
+RELATION_TAGS_PATH = "relations_tags.csv"
+RELATION_MEMBERS_PATH = "relations_members.csv"
+USERS_PATH = "users.csv"
+TAG_KEYS_PATH = "tag_keys.csv"
+MISSING_REFS_PATH = "ways_missing_nodes.csv"
 
 LOWER_COLON = re.compile(r'^([a-z]|_)+:([a-z]|_)+')
 PROBLEMCHARS = re.compile(r'[=\+/&<>;\'"\?%#$@\,\. \t\r\n]')
@@ -280,11 +299,98 @@ NODE_TAGS_FIELDS = ['id', 'key', 'value', 'type']
 WAY_FIELDS = ['id', 'user', 'uid', 'version', 'changeset', 'timestamp']
 WAY_TAGS_FIELDS = ['id', 'key', 'value', 'type']
 WAY_NODES_FIELDS = ['id', 'node_id', 'position']
+RELATION_FIELDS = ['id', 'user', 'uid', 'version', 'changeset', 'timestamp']
+RELATION_TAGS_FIELDS = ['id', 'key', 'value', 'type']
+RELATION_MEMBERS_FIELDS = ['id', 'type', 'ref', 'role', 'position']
+
+# Fields of the normalized output, where user names and tag key/type pairs move to
+# lookup tables referenced by uid and key_id
+USER_FIELDS = ['uid', 'user']
+TAG_KEY_FIELDS = ['key_id', 'key', 'type']
+NORM_NODE_FIELDS = [f for f in NODE_FIELDS if f != 'user']
+NORM_WAY_FIELDS = [f for f in WAY_FIELDS if f != 'user']
+NORM_RELATION_FIELDS = [f for f in RELATION_FIELDS if f != 'user']
+NORM_TAGS_FIELDS = ['id', 'key_id', 'value']
+
+# Distinct values a tag key may have and still get its values interned. Keys like
+# building or highway stay below it; house numbers, postcodes and names don't
+VALUES_PER_KEY = 64
+
+
+class StringTable(object):
+    """Keep a single copy of each repeated string seen while shaping
+
+    Users, tag keys and tag types are always interned. Tag values are only interned
+    per key while the key has at most values_per_key distinct values; past that its
+    values are forgotten, so the table doesn't grow with the size of the extract.
+    """
+
+    def __init__(self, values_per_key=VALUES_PER_KEY):
+        self._strings = {}
+        self._values = {}  # key -> {value: value}, or None once the key has too many
+        self.values_per_key = values_per_key
+
+    def __len__(self):
+        return len(self._strings) + sum(len(values) for values in self._values.itervalues()
+                                        if values is not None)
+
+    def intern(self, s):
+        return self._strings.setdefault(s, s)
+
+    def intern_value(self, key, s):
+        values = self._values.get(key, {})
+        if values is None:
+            return s
+        value = values.get(s)
+        if value is None:
+            if len(values) >= self.values_per_key:
+                self._values[key] = None
+                return s
+            value = values[s] = s
+            self._values[key] = values
+        return value
+
+
+class RelationMembers(object):
+    """Member rows of a relation, shaped one at a time while they are iterated
+
+    Relations can have tens of thousands of members, so unlike the way nodes their
+    rows are never collected in a list. The element must not be cleared before the
+    rows were written.
+    """
+
+    def __init__(self, element, strings=None):
+        self._element = element
+        self._strings = strings
+
+    def __len__(self):
+        return sum(1 for child in self._element if child.tag == 'member')
+
+    def __iter__(self):
+        relation_id = self._element.attrib['id']
+        strings = self._strings
+        position = 0
+        for child in self._element:
+            if child.tag == 'member':
+                member_type = child.attrib['type']
+                role = child.attrib['role']
+                if strings is not None:
+                    member_type = strings.intern(member_type)
+                    role = strings.intern_value(('member', 'role'), role)
+                yield {'id': relation_id, 'type': member_type, 'ref': child.attrib['ref'],
+                       'role': role, 'position': position}
+                position += 1
+
 
 # The function takes an iterparse Element object as input and return a dictionary.
 def shape_element(element, node_attr_fields=NODE_FIELDS, way_attr_fields=WAY_FIELDS,
-                  problem_chars=PROBLEMCHARS, default_tag_type='regular'):
-    """Clean and shape node or way XML element to Python dict"""
+                  problem_chars=PROBLEMCHARS, default_tag_type='regular', strings=None,
+                  relation_attr_fields=RELATION_FIELDS):
+    """Clean and shape node, way or relation XML element to Python dict
+
+    Pass a StringTable as strings to share one copy of each user, tag key, tag type
+    and low-cardinality tag value between all the shaped elements.
+    """
 
     node_attribs = {}
     way_attribs = {}
@@ -293,6 +399,9 @@ def shape_element(element, node_attr_fields=NODE_FIELDS, way_attr_fields=WAY_FIE
 
     way_tags = []
 
+    relation_attribs = {}
+    relation_tags = []
+
     if element.tag == "node":
         # Node attributes
         for i in element.attrib:
@@ -350,11 +459,44 @@ def shape_element(element, node_attr_fields=NODE_FIELDS, way_attr_fields=WAY_FIE
                     temp2["key"] = i.attrib["k"]
                 way_tags.append(temp2)
 
+    if element.tag == "relation":
+        # Relation attributes
+        for i in element.attrib:
+            if i in relation_attr_fields:
+                relation_attribs[i]=element.attrib[i]
+
+        # Relation's tags, split like the way tags
+        for i in element:
+            if i.tag == "tag":
+                temp3 = {}
+                temp3["id"] = element.attrib["id"]
+                temp3["value"] = i.attrib["v"]
+                k = i.attrib["k"].split(":")
+                if len(k)>1:
+                    temp3["type"] = k[0]
+                    temp3["key"] = ':'.join(k[1:3])
+                else:
+                    temp3["type"] = "regular"
+                    temp3["key"] = i.attrib["k"]
+                relation_tags.append(temp3)
+
+    if strings is not None:
+        for attribs in (node_attribs, way_attribs, relation_attribs):
+            if 'user' in attribs:
+                attribs['user'] = strings.intern(attribs['user'])
+        for tag_list in (tags, way_tags, relation_tags):
+            for tag in tag_list:
+                tag['key'] = strings.intern(tag['key'])
+                tag['type'] = strings.intern(tag['type'])
+                tag['value'] = strings.intern_value((tag['type'], tag['key']), tag['value'])
 
     if element.tag == 'node':
         return {'node': node_attribs, 'node_tags': tags}
     elif element.tag == 'way':
         return {'way': way_attribs, 'way_nodes': way_nodes, 'way_tags': way_tags}
+    elif element.tag == 'relation':
+        return {'relation': relation_attribs, 'relation_tags': relation_tags,
+                'relation_members': RelationMembers(element, strings)}
 
 
 # ================================================== #
@@ -371,6 +513,26 @@ def validate_element(element, validator, schema=SCHEMA):
         raise Exception(message_string.format(field, error_string))
 
 
+# Relation members validated at once
+MEMBERS_CHUNK_SIZE = 1000
+
+def validate_relation(element, validator, schema=SCHEMA, chunk_size=MEMBERS_CHUNK_SIZE):
+    """Raise ValidationError if a shaped relation does not match schema
+
+    The members are validated in chunks, so they never all have to be in memory.
+    """
+    validate_element({'relation': element['relation'],
+                      'relation_tags': element['relation_tags']}, validator, schema)
+    chunk = []
+    for member in element['relation_members']:
+        chunk.append(member)
+        if len(chunk) >= chunk_size:
+            validate_element({'relation_members': chunk}, validator, schema)
+            chunk = []
+    if chunk:
+        validate_element({'relation_members': chunk}, validator, schema)
+
+
 class UnicodeDictWriter(csv.DictWriter, object):
     """Extend csv.DictWriter to handle Unicode input"""
 
@@ -384,45 +546,907 @@ class UnicodeDictWriter(csv.DictWriter, object):
             self.writerow(row)
 
 
+class ElementNormalizer(object):
+    """Replace user names and tag key/type pairs by integer foreign keys
+
+    A lookup row is written to the 'users' or 'tag_keys' writer the first time
+    its uid or key/type pair is seen, so the lookup tables stream out alongside
+    the element tables. A user renamed within the extract keeps its first name.
+    """
+
+    # Shaped element keys holding a single element row with a user name
+    ELEMENT_KEYS = ('node', 'way', 'relation')
+
+    def __init__(self, users_writer, tag_keys_writer):
+        self._users_writer = users_writer
+        self._tag_keys_writer = tag_keys_writer
+        self._uids = set()
+        self._key_ids = {}
+
+    def encode_user(self, row):
+        user = row.pop('user')
+        if row['uid'] not in self._uids:
+            self._uids.add(row['uid'])
+            self._users_writer.writerow({'uid': row['uid'], 'user': user})
+        return row
+
+    def encode_tag(self, row):
+        key = (row['key'], row['type'])
+        key_id = self._key_ids.get(key)
+        if key_id is None:
+            key_id = self._key_ids[key] = len(self._key_ids) + 1
+            self._tag_keys_writer.writerow({'key_id': key_id, 'key': key[0], 'type': key[1]})
+        return {'id': row['id'], 'key_id': key_id, 'value': row['value']}
+
+    def encode(self, el):
+        for name, rows in el.items():
+            if name in self.ELEMENT_KEYS:
+                self.encode_user(rows)
+            elif name.endswith('_tags'):
+                el[name] = [self.encode_tag(row) for row in rows]
+        return el
+
+
+# ================================================== #
+#               Referential Integrity                #
+# ================================================== #
+
+MISSING_REFS_FIELDS = ['id', 'missing', 'refs']
+
+
+class NodeIdIndex(object):
+    """Compact set of node ids kept in a sorted array, optionally with a small int each
+
+    Ids are stored as doubles: exact for every id below 2**53 and 8 bytes on all
+    platforms, where 'l' is only 4 bytes on Windows. Nodes come sorted by id in OSM
+    extracts, so adding is an append; an out of order id just marks the array for
+    sorting before the next lookup.
+    """
+
+    def __init__(self, values=False):
+        self._ids = array('d')
+        self._values = array('I') if values else None
+        self._sorted = True
+
+    def __len__(self):
+        return len(self._ids)
+
+    def add(self, node_id, value=0):
+        node_id = float(node_id)
+        if self._ids and node_id < self._ids[-1]:
+            self._sorted = False
+        self._ids.append(node_id)
+        if self._values is not None:
+            self._values.append(value)
+
+    def _find(self, node_id):
+        if not self._sorted:
+            if self._values is None:
+                self._ids = array('d', sorted(self._ids))
+            else:
+                pairs = sorted(zip(self._ids, self._values))
+                self._ids = array('d', [node for node, _ in pairs])
+                self._values = array('I', [value for _, value in pairs])
+            self._sorted = True
+        node_id = float(node_id)
+        i = bisect_left(self._ids, node_id)
+        if i < len(self._ids) and self._ids[i] == node_id:
+            return i
+        return -1
+
+    def __contains__(self, node_id):
+        return self._find(node_id) >= 0
+
+    def get(self, node_id, default=None):
+        i = self._find(node_id)
+        return default if i < 0 else self._values[i]
+
+
+class RefIntegrityChecker(object):
+    """Check that every node referenced by a way was seen earlier in the stream
+
+    OSM files list all nodes before the ways, so each way is checked as soon as it
+    is shaped. mode decides what process_map does with a way missing nodes:
+    'report' writes it anyway, 'drop' skips it and 'quarantine' writes it to the
+    *_quarantine.csv files instead. Either way it is counted in missing.
+    """
+
+    MODES = ('report', 'drop', 'quarantine')
+
+    def __init__(self, mode='report'):
+        if mode not in self.MODES:
+            raise ValueError("mode must be one of {0}, not {1!r}".format(self.MODES, mode))
+        self.mode = mode
+        self.nodes = NodeIdIndex()
+        self.missing = {}  # way id -> (missing refs, total refs)
+        self.refs_checked = 0
+        self.refs_missing = 0
+
+    def add_node(self, node_id):
+        self.nodes.add(node_id)
+
+    def check_way(self, way_id, way_nodes):
+        """Return the number of refs in way_nodes to nodes that weren't seen"""
+        missing = 0
+        for way_node in way_nodes:
+            if way_node['node_id'] not in self.nodes:
+                missing += 1
+        self.refs_checked += len(way_nodes)
+        if missing:
+            self.refs_missing += missing
+            self.missing[way_id] = (missing, len(way_nodes))
+        return missing
+
+    def report(self):
+        return "{0} of {1} way node refs missing, in {2} ways ({3})".format(
+            self.refs_missing, self.refs_checked, len(self.missing), self.mode)
+
+    def write_report(self, path=MISSING_REFS_PATH):
+        with codecs.open(path, 'w') as f:
+            writer = UnicodeDictWriter(f, MISSING_REFS_FIELDS)
+            writer.writeheader()
+            for way_id in sorted(self.missing, key=int):
+                missing, refs = self.missing[way_id]
+                writer.writerow({'id': way_id, 'missing': missing, 'refs': refs})
+
+
+# ================================================== #
+#               Partitioned Output                   #
+# ================================================== #
+
+PARTITIONS_DIR = "partitions"
+MANIFEST_NAME = "manifest.json"
+# Partition of the ways whose first node isn't in the extract
+UNPARTITIONED = "none"
+# Geohash precision 4 is ~39km x 20km, map tile zoom 10 is ~39km x 31km at Las Vegas
+GEOHASH_PRECISION = 4
+TILE_ZOOM = 10
+# Bytes of csv rows buffered over all partitions; past it the largest buffer is
+# appended to its partition's csv files
+PARTITION_BUFFER_BUDGET = 1 << 25
+# Flushes the background writer may queue, each up to the largest partition buffer
+PARTITION_FLUSH_QUEUE_DEPTH = 2
+# Elements written between two checks of the buffered bytes
+PARTITION_CHECK_INTERVAL = 1000
+
+_GEOHASH_BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+def geohash(lat, lon, precision=GEOHASH_PRECISION):
+    """Return the geohash of lat/lon with precision characters"""
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    chars = []
+    ch = bit = 0
+    even = True
+    while len(chars) < precision:
+        # Bits alternate between longitude and latitude, starting with longitude
+        value, bounds = (lon, lon_range) if even else (lat, lat_range)
+        mid = (bounds[0] + bounds[1]) / 2
+        if value >= mid:
+            ch = ch << 1 | 1
+            bounds[0] = mid
+        else:
+            ch <<= 1
+            bounds[1] = mid
+        even = not even
+        bit += 1
+        if bit == 5:
+            chars.append(_GEOHASH_BASE32[ch])
+            ch = bit = 0
+    return ''.join(chars)
+
+def tile_key(lat, lon, zoom=TILE_ZOOM):
+    """Return the slippy map tile of lat/lon at zoom as 'zoom_x_y'"""
+    n = 2 ** zoom
+    lat_rad = math.radians(lat)
+    x = int((lon + 180.0) / 360.0 * n)
+    y = int((1.0 - math.log(math.tan(lat_rad) + 1.0 / math.cos(lat_rad)) / math.pi) / 2.0 * n)
+    return "{0}_{1}_{2}".format(zoom, min(max(x, 0), n - 1), min(max(y, 0), n - 1))
+
+
+class Partitioner(object):
+    """Route shaped rows to partitions by geohash or map tile of their position, or by year
+
+    Nodes pick their partition from their own row. With the geohash and tile schemes
+    ways follow their first node and relations their first node or else their first
+    way; with the year scheme every element goes by its own timestamp. Tags and members
+    follow their parent element. Each partition gets its own directory of csv files,
+    named after its key, under directory, and write_manifest records their row counts
+    and bounds.
+    """
+
+    SCHEMES = ('geohash', 'tile', 'year')
+
+    def __init__(self, scheme='geohash', precision=GEOHASH_PRECISION, zoom=TILE_ZOOM,
+                 directory=PARTITIONS_DIR, buffer_budget=PARTITION_BUFFER_BUDGET):
+        if scheme not in self.SCHEMES:
+            raise ValueError("scheme must be one of {0}, not {1!r}".format(self.SCHEMES, scheme))
+        self.scheme = scheme
+        self.precision = precision
+        self.zoom = zoom
+        self.directory = directory
+        self.buffer_budget = buffer_budget
+        self.keys = []
+        self._key_index = {}
+        self._nodes = NodeIdIndex(values=True)
+        self._ways = NodeIdIndex(values=True)
+        self.partitions = {}
+
+    def _partition(self, key):
+        partition = self.partitions.get(key)
+        if partition is None:
+            partition = self.partitions[key] = {'rows': defaultdict(int), 'bounds': {}}
+        return partition
+
+    def _extend_bounds(self, bounds, field, value):
+        low, high = 'min_' + field, 'max_' + field
+        if low not in bounds or value < bounds[low]:
+            bounds[low] = value
+        if high not in bounds or value > bounds[high]:
+            bounds[high] = value
+
+    def _index(self, key):
+        index = self._key_index.get(key)
+        if index is None:
+            index = self._key_index[key] = len(self.keys)
+            self.keys.append(key)
+        return index
+
+    def node_key(self, node):
+        if self.scheme == 'geohash':
+            key = geohash(float(node['lat']), float(node['lon']), self.precision)
+        elif self.scheme == 'tile':
+            key = tile_key(float(node['lat']), float(node['lon']), self.zoom)
+        else:
+            key = node['timestamp'][:4]
+
+        index = self._index(key)
+        # Only the spatial schemes route ways and relations through their nodes
+        if self.scheme != 'year':
+            self._nodes.add(node['id'], index)
+        bounds = self._partition(key)['bounds']
+        self._extend_bounds(bounds, 'lat', float(node['lat']))
+        self._extend_bounds(bounds, 'lon', float(node['lon']))
+        return key
+
+    def way_key(self, way, way_nodes):
+        if self.scheme == 'year':
+            key = way['timestamp'][:4]
+            self._index(key)
+            return key
+        if not way_nodes:
+            return UNPARTITIONED
+        index = self._nodes.get(way_nodes[0]['node_id'])
+        if index is None:
+            return UNPARTITIONED
+        # Remembered for the relations that only have way members
+        self._ways.add(way_nodes[0]['id'], index)
+        return self.keys[index]
+
+    def relation_key(self, relation, members):
+        if self.scheme == 'year':
+            key = relation['timestamp'][:4]
+            self._index(key)
+            return key
+        # The first node member in the extract decides, else the first way member.
+        # Relations of only relations, or of missing members, stay unpartitioned
+        way_index = None
+        first_way = True
+        for member in members:
+            if member['type'] == 'node':
+                index = self._nodes.get(member['ref'])
+                if index is not None:
+                    return self.keys[index]
+            elif member['type'] == 'way' and first_way:
+                first_way = False
+                way_index = self._ways.get(member['ref'])
+        return UNPARTITIONED if way_index is None else self.keys[way_index]
+
+    def add_rows(self, key, el):
+        """Count the rows of shaped element el and extend the bounds of partition key
+
+        Every element's timestamp extends the timestamp bounds, as with the spatial
+        schemes ways and relations have their own dates. lat/lon bounds only come from
+        the nodes.
+        """
+        partition = self._partition(key)
+        for name, rows in el.iteritems():
+            if isinstance(rows, dict):
+                partition['rows'][name] += 1
+                self._extend_bounds(partition['bounds'], 'timestamp', rows['timestamp'])
+            else:
+                partition['rows'][name] += len(rows)
+
+    def write_manifest(self):
+        manifest = {'scheme': self.scheme, 'precision': self.precision, 'zoom': self.zoom,
+                    'partitions': self.partitions}
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        with open(os.path.join(self.directory, MANIFEST_NAME), 'w') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+
+
+class PartitionBuffers(object):
+    """Buffer the csv rows of every partition in memory and append them in large writes
+
+    Rows are written as csv text to one buffer per partition and table. Once all the
+    buffers hold more than buffer_budget bytes, the partition with the most buffered
+    bytes is appended to its csv files, which are only open during that write. With
+    background=True the writes are done by one writer thread.
+    """
+
+    def __init__(self, directory, tables, buffer_budget=PARTITION_BUFFER_BUDGET,
+                 background=False, queue_depth=PARTITION_FLUSH_QUEUE_DEPTH, metrics=None):
+        self.directory = directory
+        self.tables = tables
+        self.buffer_budget = buffer_budget
+        self._buffers = {}
+        self._writers = {}
+        self._sizes = {}
+        self._size = 0
+        self._dirty = set()
+        self._unchecked = 0
+        self._started = set()
+        self._error = None
+        self._queue = None
+        if background:
+            self._queue = Queue.Queue(maxsize=queue_depth)
+            self._metrics = metrics if metrics is not None else PipelineMetrics()
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def writers(self, key):
+        """Return the writers of partition key by table name"""
+        writers = self._writers.get(key)
+        if writers is None:
+            buffers = self._buffers[key] = {}
+            writers = self._writers[key] = {}
+            for name, path, fields in self.tables:
+                buffers[name] = cStringIO.StringIO()
+                writers[name] = UnicodeDictWriter(buffers[name], fields)
+                writers[name].writeheader()
+            self._sizes[key] = 0
+        return writers
+
+    def written(self, key):
+        """Note the element just written to partition key, flushing when over budget
+
+        The buffered bytes are only added up every PARTITION_CHECK_INTERVAL elements.
+        """
+        self._dirty.add(key)
+        self._unchecked += 1
+        if self._unchecked < PARTITION_CHECK_INTERVAL:
+            return
+        self._unchecked = 0
+        for dirty in self._dirty:
+            size = sum(buf.tell() for buf in self._buffers[dirty].itervalues())
+            self._size += size - self._sizes[dirty]
+            self._sizes[dirty] = size
+        self._dirty.clear()
+        while self._size > self.buffer_budget:
+            self.flush(max(self._sizes, key=self._sizes.get))
+
+    def flush(self, key):
+        """Append the buffered rows of partition key to its csv files"""
+        self._dirty.discard(key)
+        files = []
+        for name, path, fields in self.tables:
+            buf = self._buffers[key][name]
+            files.append((os.path.join(self.directory, key, path), buf.getvalue()))
+            buf.seek(0)
+            buf.truncate()
+        self._size -= self._sizes[key]
+        self._sizes[key] = 0
+        append = key in self._started
+        self._started.add(key)
+        if self._queue is None:
+            self._write(key, files, append)
+        else:
+            if self._error is not None:
+                raise self._error
+            start = time.time()
+            self._queue.put((key, files, append))
+            self._metrics.add('parser (waiting on writers)', time.time() - start)
+
+    def _write(self, key, files, append):
+        directory = os.path.join(self.directory, key)
+        if not append and not os.path.isdir(directory):
+            os.makedirs(directory)
+        for path, data in files:
+            with open(path, 'ab' if append else 'wb') as f:
+                f.write(data)
+
+    def _run(self):
+        stalled = 0.0
+        flushes = 0
+        while True:
+            start = time.time()
+            item = self._queue.get()
+            stalled += time.time() - start
+            if item is None:
+                break
+            # Keep draining after an error so the parser never blocks on a dead writer
+            if self._error is None:
+                try:
+                    self._write(*item)
+                    flushes += 1
+                except Exception as e:
+                    self._error = e
+        self._metrics.add('writer partitions', stalled, flushes)
+
+    def close(self):
+        """Flush every partition and wait for the writer thread"""
+        try:
+            for key in sorted(self._buffers):
+                if key in self._dirty or self._sizes[key]:
+                    self.flush(key)
+        finally:
+            if self._queue is not None:
+                self._queue.put(None)
+                self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+
+def load_manifest(directory=PARTITIONS_DIR):
+    with open(os.path.join(directory, MANIFEST_NAME)) as f:
+        return json.load(f)
+
+def select_partitions(manifest, bbox=None, years=None):
+    """Return the keys of the partitions that may hold rows in bbox and years
+
+    bbox is (min_lat, min_lon, max_lat, max_lon) and years (first, last), both inclusive.
+    The bbox is checked against the nodes of a partition, so a way or relation is found
+    by the position of the node it follows. Partitions without lat/lon bounds (ways
+    whose first node is missing) are only pruned by years.
+    """
+    keys = []
+    for key, partition in sorted(manifest['partitions'].iteritems()):
+        bounds = partition['bounds']
+        if bbox is not None and 'min_lat' in bounds and (
+                bounds['max_lat'] < bbox[0] or bounds['max_lon'] < bbox[1] or
+                bounds['min_lat'] > bbox[2] or bounds['min_lon'] > bbox[3]):
+            continue
+        if years is not None and 'min_timestamp' in bounds and (
+                int(bounds['max_timestamp'][:4]) < years[0] or
+                int(bounds['min_timestamp'][:4]) > years[1]):
+            continue
+        keys.append(key)
+    return keys
+
+def load_partitions(load, directory=PARTITIONS_DIR, bbox=None, years=None, threads=4):
+    """Call load(key, partition directory) for each selected partition on a thread pool
+
+    The partition directories are found under directory, so the partitions can be
+    moved or loaded from another working directory. Returns the results in key order.
+    """
+    manifest = load_manifest(directory)
+    keys = select_partitions(manifest, bbox, years)
+    pool = ThreadPool(threads)
+    try:
+        return pool.map(lambda key: load(key, os.path.join(directory, key)), keys)
+    finally:
+        pool.close()
+        pool.join()
+
+
+# ================================================== #
+#               Pipelined Execution                  #
+# ================================================== #
+
+# Bytes the reader thread reads ahead per chunk, and how many chunks it may queue
+READ_CHUNK_SIZE = 1 << 20
+READ_QUEUE_DEPTH = 16
+# Rows handed to a writer thread at once, and how many batches it may queue
+WRITE_BATCH_SIZE = 1000
+WRITE_QUEUE_DEPTH = 64
+# Output buffer of each csv file
+WRITE_BUFFER_SIZE = 1 << 22
+
+
+class BufferedTableWriter(UnicodeDictWriter):
+    """UnicodeDictWriter that owns its csv file and writes through a large buffer"""
+
+    def __init__(self, path, fields, buffer_size=WRITE_BUFFER_SIZE):
+        # codecs.open defaults to line buffering, i.e. one write call per csv row
+        self._file = codecs.open(path, 'w', buffering=buffer_size)
+        super(BufferedTableWriter, self).__init__(self._file, fields)
+
+    def close(self):
+        self._file.close()
+
+
+class PipelineMetrics(object):
+    """Collect the time each stage of process_map spends stalled on a queue
+
+    - 'reader' stalls when the parser can't keep up with the disk
+    - 'parser (waiting on reader)' stalls when the disk can't keep up with the parser
+    - 'parser (waiting on writers)' stalls when a writer thread can't keep up
+    - 'writer <table>' stalls when the parser can't produce rows fast enough
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stalls = defaultdict(float)
+        self.items = defaultdict(int)
+        self.elapsed = 0.0
+
+    def add(self, stage, seconds, items=0):
+        with self._lock:
+            self.stalls[stage] += seconds
+            self.items[stage] += items
+
+    def report(self):
+        lines = ["elapsed: {0:.2f}s".format(self.elapsed)]
+        for stage in sorted(self.stalls):
+            lines.append("{0}: {1:.2f}s stalled, {2} items".format(
+                stage, self.stalls[stage], self.items[stage]))
+        return "\n".join(lines)
+
+
+class PrefetchReader(object):
+    """File-like object whose chunks are read ahead by a background thread
+
+    Like a pipe, read() may return fewer bytes than asked for, which is all
+    iterparse needs.
+    """
+
+    def __init__(self, path, chunk_size=READ_CHUNK_SIZE, queue_depth=READ_QUEUE_DEPTH,
+                 metrics=None):
+        self._queue = Queue.Queue(maxsize=queue_depth)
+        self._metrics = metrics if metrics is not None else PipelineMetrics()
+        self._chunk = ''
+        self._pos = 0
+        self._eof = False
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, args=(path, chunk_size))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self, path, chunk_size):
+        stalled = 0.0
+        chunks = 0
+        try:
+            with open(path, 'rb') as f:
+                while not self._closed:
+                    chunk = f.read(chunk_size)
+                    start = time.time()
+                    self._queue.put(chunk)
+                    stalled += time.time() - start
+                    if not chunk:
+                        break
+                    chunks += 1
+        except Exception as e:
+            self._queue.put(e)
+        self._metrics.add('reader', stalled, chunks)
+
+    def read(self, size=-1):
+        if self._pos >= len(self._chunk):
+            if self._eof:
+                return ''
+            start = time.time()
+            chunk = self._queue.get()
+            self._metrics.add('parser (waiting on reader)', time.time() - start)
+            if isinstance(chunk, Exception):
+                raise chunk
+            if not chunk:
+                self._eof = True
+                return ''
+            self._chunk, self._pos = chunk, 0
+
+        end = len(self._chunk) if size < 0 else self._pos + size
+        data = self._chunk[self._pos:end]
+        self._pos = end
+        return data
+
+    def close(self):
+        # Unblock the reader thread if the parser stopped early
+        self._closed = True
+        while self._thread.is_alive():
+            try:
+                self._queue.get(timeout=0.1)
+            except Queue.Empty:
+                pass
+
+
+class QueuedWriter(object):
+    """Write the rows of one output table on a background thread
+
+    Rows are collected into batches on the calling thread and handed over through
+    a bounded queue, so a slow disk eventually blocks the parser instead of
+    filling up memory.
+    """
+
+    def __init__(self, name, path, fields, queue_depth=WRITE_QUEUE_DEPTH,
+                 batch_size=WRITE_BATCH_SIZE, buffer_size=WRITE_BUFFER_SIZE, metrics=None):
+        self.name = name
+        self._writer = BufferedTableWriter(path, fields, buffer_size)
+        self._queue = Queue.Queue(maxsize=queue_depth)
+        self._batch = []
+        self._batch_size = batch_size
+        self._metrics = metrics if metrics is not None else PipelineMetrics()
+        self._error = None
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        stalled = 0.0
+        rows = 0
+        while True:
+            start = time.time()
+            batch = self._queue.get()
+            stalled += time.time() - start
+            if batch is None:
+                break
+            # Keep draining after an error so the parser never blocks on a dead writer
+            if self._error is None:
+                try:
+                    self._writer.writerows(batch)
+                    rows += len(batch)
+                except Exception as e:
+                    self._error = e
+        self._metrics.add('writer ' + self.name, stalled, rows)
+
+    def _flush(self):
+        if self._error is not None:
+            raise self._error
+        if self._batch:
+            start = time.time()
+            self._queue.put(self._batch)
+            self._metrics.add('parser (waiting on writers)', time.time() - start)
+            self._batch = []
+
+    def writeheader(self):
+        # Safe on this thread: the writer thread only touches the file once rows arrive
+        self._writer.writeheader()
+
+    def writerow(self, row):
+        self._batch.append(row)
+        if len(self._batch) >= self._batch_size:
+            self._flush()
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+    def close(self):
+        try:
+            self._flush()
+        finally:
+            self._queue.put(None)
+            self._thread.join()
+            self._writer.close()
+        if self._error is not None:
+            raise self._error
+
+
+def close_all(closeables):
+    """Close every object in closeables, even after one fails
+
+    Returns the sys.exc_info() of the first failure, or None.
+    """
+    error = None
+    for closeable in closeables:
+        try:
+            closeable.close()
+        except Exception:
+            if error is None:
+                error = sys.exc_info()
+    return error
+
+
 # ================================================== #
 #               Main Function                        #
 # ================================================== #
-def process_map(file_in, validate):
-    """Iteratively process each XML element and write to csv(s)"""
-
-    with codecs.open(NODES_PATH, 'w') as nodes_file, \
-         codecs.open(NODE_TAGS_PATH, 'w') as nodes_tags_file, \
-         codecs.open(WAYS_PATH, 'w') as ways_file, \
-         codecs.open(WAY_NODES_PATH, 'w') as way_nodes_file, \
-         codecs.open(WAY_TAGS_PATH, 'w') as way_tags_file:
-
-        nodes_writer = UnicodeDictWriter(nodes_file, NODE_FIELDS)
-        node_tags_writer = UnicodeDictWriter(nodes_tags_file, NODE_TAGS_FIELDS)
-        ways_writer = UnicodeDictWriter(ways_file, WAY_FIELDS)
-        way_nodes_writer = UnicodeDictWriter(way_nodes_file, WAY_NODES_FIELDS)
-        way_tags_writer = UnicodeDictWriter(way_tags_file, WAY_TAGS_FIELDS)
-
-        nodes_writer.writeheader()
-        node_tags_writer.writeheader()
-        ways_writer.writeheader()
-        way_nodes_writer.writeheader()
-        way_tags_writer.writeheader()
+
+# Output tables: (shaped element key, csv path, csv fields)
+TABLES = [('node', NODES_PATH, NODE_FIELDS),
+          ('node_tags', NODE_TAGS_PATH, NODE_TAGS_FIELDS),
+          ('way', WAYS_PATH, WAY_FIELDS),
+          ('way_nodes', WAY_NODES_PATH, WAY_NODES_FIELDS),
+          ('way_tags', WAY_TAGS_PATH, WAY_TAGS_FIELDS),
+          ('relation', RELATIONS_PATH, RELATION_FIELDS),
+          ('relation_tags', RELATION_TAGS_PATH, RELATION_TAGS_FIELDS),
+          ('relation_members', RELATION_MEMBERS_PATH, RELATION_MEMBERS_FIELDS)]
+
+# Output tables when normalize=True
+NORMALIZED_TABLES = [('users', USERS_PATH, USER_FIELDS),
+                     ('tag_keys', TAG_KEYS_PATH, TAG_KEY_FIELDS),
+                     ('node', NODES_PATH, NORM_NODE_FIELDS),
+                     ('node_tags', NODE_TAGS_PATH, NORM_TAGS_FIELDS),
+                     ('way', WAYS_PATH, NORM_WAY_FIELDS),
+                     ('way_nodes', WAY_NODES_PATH, WAY_NODES_FIELDS),
+                     ('way_tags', WAY_TAGS_PATH, NORM_TAGS_FIELDS),
+                     ('relation', RELATIONS_PATH, NORM_RELATION_FIELDS),
+                     ('relation_tags', RELATION_TAGS_PATH, NORM_TAGS_FIELDS),
+                     ('relation_members', RELATION_MEMBERS_PATH, RELATION_MEMBERS_FIELDS)]
+
+# Way tables that get a quarantine copy when integrity.mode == 'quarantine'
+QUARANTINE_TABLES = ('way', 'way_nodes', 'way_tags')
+QUARANTINE_PREFIX = 'quarantine_'
+
+def quarantine_path(path):
+    return path.replace('.csv', '_quarantine.csv')
+
+# Tables split up by a Partitioner; lookup and quarantine tables stay whole
+PARTITIONED_TABLES = ('node', 'node_tags', 'way', 'way_nodes', 'way_tags',
+                      'relation', 'relation_tags', 'relation_members')
+
+def process_map(file_in, validate, pipelined=False, metrics=None,
+                read_chunk_size=READ_CHUNK_SIZE, read_queue_depth=READ_QUEUE_DEPTH,
+                write_batch_size=WRITE_BATCH_SIZE, write_queue_depth=WRITE_QUEUE_DEPTH,
+                write_buffer_size=WRITE_BUFFER_SIZE, strings=None, normalize=False,
+                integrity=None, use_cache=False, partitioner=None):
+    """Iteratively process each XML element and write to csv(s)
+
+    With pipelined=True a reader thread prefetches the input file, this thread parses
+    and shapes the elements, and one writer thread per table writes the csv files.
+    Returns the PipelineMetrics (pass one in to accumulate over several runs).
+
+    Pass a StringTable as strings to intern repeated strings while shaping. With
+    normalize=True user names and tag keys are also written once to users.csv and
+    tag_keys.csv, and referenced from the other tables by uid and key_id.
+
+    Pass a RefIntegrityChecker as integrity to check the nodes referenced by each way
+    and report, drop or quarantine the ways missing some.
+
+    With use_cache=True the elements are read from the osm_cache of file_in, which is
+    built on the first run (the reader thread is then not used).
+
+    Pass a Partitioner to write the node, way and relation tables into one directory
+    per partition, plus a manifest of their row counts and bounds.
+    """
+    if metrics is None:
+        metrics = PipelineMetrics()
+    if normalize and strings is None:
+        strings = StringTable()
+    tables = NORMALIZED_TABLES if normalize else TABLES
+    if integrity is not None and integrity.mode == 'quarantine':
+        tables = tables + [(QUARANTINE_PREFIX + name, quarantine_path(path), fields)
+                           for name, path, fields in tables if name in QUARANTINE_TABLES]
+    started = time.time()
+
+    source = file_in
+    if pipelined and not use_cache:
+        source = PrefetchReader(file_in, read_chunk_size, read_queue_depth, metrics)
+    if pipelined:
+        def open_writer(name, path, fields):
+            return QueuedWriter(name, path, fields, write_queue_depth, write_batch_size,
+                                write_buffer_size, metrics)
+    else:
+        def open_writer(name, path, fields):
+            return BufferedTableWriter(path, fields, write_buffer_size)
+
+    partitions = None
+    if partitioner is not None:
+        partitions = PartitionBuffers(
+            partitioner.directory,
+            [table for table in tables if table[0] in PARTITIONED_TABLES],
+            partitioner.buffer_budget, background=pipelined, metrics=metrics)
+        tables = [table for table in tables if table[0] not in PARTITIONED_TABLES]
+
+    writers = {}
+    completed = False
+    try:
+        for name, path, fields in tables:
+            writers[name] = open_writer(name, path, fields)
+            writers[name].writeheader()
 
         validator = cerberus.Validator()
+        normalizer = None
+        if normalize:
+            normalizer = ElementNormalizer(writers['users'], writers['tag_keys'])
+
+        if use_cache:
+            elements = iter_elements(file_in, tags=('node', 'way', 'relation'))
+        else:
+            elements = get_element(source, tags=('node', 'way', 'relation'))
 
-        for element in get_element(file_in, tags=('node', 'way')):
-            el = shape_element(element)
+        for element in elements:
+            el = shape_element(element, strings=strings)
             if el:
                 if validate is True:
-                    validate_element(el, validator)
+                    if element.tag == 'relation':
+                        validate_relation(el, validator)
+                    else:
+                        validate_element(el, validator)
+
+                prefix = ''
+                if integrity is not None:
+                    if element.tag == 'node':
+                        integrity.add_node(el['node']['id'])
+                    elif element.tag == 'way' and integrity.check_way(el['way']['id'],
+                                                                      el['way_nodes']):
+                        if integrity.mode == 'drop':
+                            continue
+                        if integrity.mode == 'quarantine':
+                            prefix = QUARANTINE_PREFIX
+
+                if normalizer is not None:
+                    normalizer.encode(el)
+
+                out = writers
+                if partitioner is not None and not prefix:
+                    if element.tag == 'node':
+                        key = partitioner.node_key(el['node'])
+                    elif element.tag == 'way':
+                        key = partitioner.way_key(el['way'], el['way_nodes'])
+                    else:
+                        key = partitioner.relation_key(el['relation'],
+                                                       el['relation_members'])
+                    out = partitions.writers(key)
+                    partitioner.add_rows(key, el)
 
                 if element.tag == 'node':
-                    nodes_writer.writerow(el['node'])
-                    node_tags_writer.writerows(el['node_tags'])
+                    out['node'].writerow(el['node'])
+                    out['node_tags'].writerows(el['node_tags'])
                 elif element.tag == 'way':
-                    ways_writer.writerow(el['way'])
-                    way_nodes_writer.writerows(el['way_nodes'])
-                    way_tags_writer.writerows(el['way_tags'])
+                    out[prefix + 'way'].writerow(el['way'])
+                    out[prefix + 'way_nodes'].writerows(el['way_nodes'])
+                    out[prefix + 'way_tags'].writerows(el['way_tags'])
+                elif element.tag == 'relation':
+                    out['relation'].writerow(el['relation'])
+                    out['relation_tags'].writerows(el['relation_tags'])
+                    out['relation_members'].writerows(el['relation_members'])
+
+                if out is not writers:
+                    partitions.written(key)
+        completed = True
+    finally:
+        closeables = writers.values()
+        if partitions is not None:
+            closeables.append(partitions)
+        if source is not file_in:
+            closeables.append(source)
+        error = close_all(closeables)
+        # An error while closing is only raised when it doesn't hide one from the loop
+        if error is not None and completed:
+            raise error[0], error[1], error[2]
+
+    if partitioner is not None:
+        partitioner.write_manifest()
+
+    metrics.elapsed += time.time() - started
+    return metrics
+
+
+# Writing a synthetic extract whose consecutive node ids lie anywhere in bbox, so the
+# partition changes on nearly every element, with ways of 5 random nodes
+def write_shuffled_osm(path, nodes=200000, ways=20000, bbox=(35.0, -117.0, 37.0, -114.0),
+                       seed=1):
+    import random
+    rand = random.Random(seed)
+    with open(path, 'wb') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<osm version="0.6">\n')
+        for i in xrange(1, nodes + 1):
+            f.write(' <node id="%d" lat="%.7f" lon="%.7f" version="1" changeset="1" '
+                    'timestamp="20%02d-01-01T00:00:00Z" uid="%d" user="user%d"/>\n' % (
+                        i, rand.uniform(bbox[0], bbox[2]), rand.uniform(bbox[1], bbox[3]),
+                        rand.randint(8, 17), i % 100, i % 100))
+        for i in xrange(1, ways + 1):
+            f.write(' <way id="%d" version="1" changeset="1" timestamp="2015-01-01T00:00:00Z" '
+                    'uid="1" user="user1">\n' % i)
+            for _ in range(5):
+                f.write('  <nd ref="%d"/>\n' % rand.randint(1, nodes))
+            f.write('  <tag k="building" v="yes"/>\n </way>\n')
+        f.write('</osm>\n')
+
+# Returning the seconds process_map takes on osm_file unpartitioned and partitioned,
+# sequential and pipelined
+def benchmark_partitions(osm_file, directory="benchmark_partitions", **partition_args):
+    results = {}
+    for pipelined in (False, True):
+        mode = "pipelined" if pipelined else "sequential"
+        start = time.time()
+        process_map(osm_file, validate=False, pipelined=pipelined)
+        results[mode + " unpartitioned"] = time.time() - start
+        partitioner = Partitioner(directory=directory, **partition_args)
+        start = time.time()
+        process_map(osm_file, validate=False, pipelined=pipelined, partitioner=partitioner)
+        results["{0} {1} partitions".format(mode, len(partitioner.keys))] = time.time() - start
+    return results
 
 
 if __name__ == '__main__':
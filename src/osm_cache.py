@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+- Caching the parsed node, way and relation stream of an OSM file, so the audits and
+    process_map can be rerun while tuning the 'mapping' table without parsing the same
+    XML again.
+
+- The cache lives next to the OSM file ("las-vegas_nevada.osm.cache"). It starts with a
+    fixed size header holding the size, mtime and sha1 of the source file, followed by
+    length-prefixed, marshal'ed batches of records. It is rebuilt automatically when the
+    source changes; a source that was only touched is re-hashed instead.
+
+- A record stores the attribute values of its element and children by position, in a
+    fixed order per tag, so attribute names aren't repeated. User names, tag keys and
+    member roles are interned: marshal writes an interned string once per batch and
+    refers back to it by index afterwards, which gives each batch its string table.
+
+- iter_elements yields CachedElement objects, which support the parts of the ElementTree
+    API the audits and shape_element use (tag, attrib, get, iter and iterating children).
+"""
+import xml.etree.cElementTree as ET
+import hashlib
+import marshal
+import os
+import struct
+
+OSMFILE = "las-vegas_nevada.osm"
+
+CACHE_VERSION = 2
+CACHE_SUFFIX = ".cache"
+# Bytes reserved for the header, so it can be rewritten in place
+HEADER_SIZE = 256
+# Records per marshal'ed batch
+BATCH_SIZE = 1000
+# Buffer used when reading the source file and the cache
+BUFFER_SIZE = 1 << 20
+# Byte length written in front of each batch
+BATCH_LENGTH = struct.Struct('<I')
+
+# Attributes stored by position, per element and child tag. Other attributes are kept
+# in a dict next to them; an element missing one of these is stored as a dict only
+ATTRIBUTES = {'node': ('id', 'lat', 'lon', 'version', 'timestamp', 'changeset', 'uid', 'user'),
+              'way': ('id', 'version', 'timestamp', 'changeset', 'uid', 'user'),
+              'relation': ('id', 'version', 'timestamp', 'changeset', 'uid', 'user'),
+              'tag': ('k', 'v'),
+              'nd': ('ref',),
+              'member': ('type', 'ref', 'role')}
+# Attributes whose values repeat across records and go into the batch's string table
+INTERNED_ATTRIBUTES = frozenset(['user', 'k', 'type', 'role'])
+
+
+class CachedElement(object):
+    """Top level element or child read back from the cache
+
+    Its attrib dict is only built from the packed values when it's first used.
+    """
+
+    __slots__ = ('tag', '_values', '_extra', '_attrib', '_children')
+
+    def __init__(self, tag, values, extra=None, children=()):
+        self.tag = tag
+        self._values = values
+        self._extra = extra
+        self._attrib = None
+        self._children = children
+
+    @property
+    def attrib(self):
+        if self._attrib is None:
+            self._attrib = _unpack(self.tag, self._values, self._extra)
+        return self._attrib
+
+    def __iter__(self):
+        return iter(self._children)
+
+    def __len__(self):
+        return len(self._children)
+
+    def get(self, key, default=None):
+        return self.attrib.get(key, default)
+
+    def set(self, key, value):
+        self.attrib[key] = value
+
+    def iter(self, tag=None):
+        if tag is None or self.tag == tag:
+            yield self
+        for child in self._children:
+            if tag is None or child.tag == tag:
+                yield child
+
+
+class _HashingReader(object):
+    """File wrapper computing the sha1 of everything read through it"""
+
+    def __init__(self, f):
+        self._file = f
+        self.sha1 = hashlib.sha1()
+
+    def read(self, size=-1):
+        data = self._file.read(size)
+        self.sha1.update(data)
+        return data
+
+
+def cache_path_for(osm_file):
+    return osm_file + CACHE_SUFFIX
+
+
+def file_sha1(path):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(BUFFER_SIZE), ''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def _pack(tag, attrib):
+    """Return (tag, values, extra) for an element with attrib"""
+    names = ATTRIBUTES.get(tag, ())
+    values = []
+    for name in names:
+        value = attrib.get(name)
+        if value is None:
+            return intern(tag), None, dict(attrib)
+        # ElementTree returns non-ascii values as unicode, which can't be interned
+        if name in INTERNED_ATTRIBUTES and type(value) is str:
+            value = intern(value)
+        values.append(value)
+    extra = None
+    if len(attrib) > len(names):
+        extra = dict((name, value) for name, value in attrib.iteritems() if name not in names)
+    return intern(tag), tuple(values), extra
+
+
+def _unpack(tag, values, extra):
+    """Return the attrib dict of a record packed by _pack"""
+    if values is None:
+        return extra
+    attrib = dict(zip(ATTRIBUTES[tag], values))
+    if extra is not None:
+        attrib.update(extra)
+    return attrib
+
+
+def _write_batch(f, batch):
+    data = marshal.dumps(batch)
+    f.write(BATCH_LENGTH.pack(len(data)))
+    f.write(data)
+
+
+def _write_header(f, header):
+    data = marshal.dumps(header)
+    f.seek(0)
+    f.write(data + ' ' * (HEADER_SIZE - len(data)))
+
+
+def _read_header(f):
+    # marshal.loads ignores the padding after the header
+    return marshal.loads(f.read(HEADER_SIZE))
+
+
+def is_valid(osm_file, cache_path=None):
+    """Return True if the cache of osm_file exists and matches the current source"""
+    if cache_path is None:
+        cache_path = cache_path_for(osm_file)
+    if not os.path.exists(cache_path):
+        return False
+    st = os.stat(osm_file)
+    try:
+        with open(cache_path, 'rb') as f:
+            header = _read_header(f)
+        if header['version'] != CACHE_VERSION or header['size'] != st.st_size:
+            return False
+        if header['mtime'] == st.st_mtime:
+            return True
+        # Same size but touched: only the content decides
+        if header['sha1'] != file_sha1(osm_file):
+            return False
+    except (IOError, EOFError, ValueError, TypeError, KeyError):
+        return False
+    # The new mtime is recorded so the next check is cheap again, unless the cache
+    # can't be written, e.g. when it's shared read-only
+    header['mtime'] = st.st_mtime
+    try:
+        with open(cache_path, 'r+b') as f:
+            _write_header(f, header)
+    except IOError:
+        pass
+    return True
+
+
+def build_cache(osm_file, cache_path=None, tags=('node', 'way', 'relation')):
+    """Parse osm_file, writing its cache, and yield the parsed elements in tags
+
+    The cache is written to a temporary file and only replaces the old one once the
+    whole source was parsed, so stopping early leaves no partial cache behind.
+    """
+    if cache_path is None:
+        cache_path = cache_path_for(osm_file)
+    tmp_path = cache_path + '.tmp'
+    st = os.stat(osm_file)
+
+    with open(osm_file, 'rb', BUFFER_SIZE) as source, open(tmp_path, 'wb', BUFFER_SIZE) as out:
+        try:
+            _write_header(out, {'version': CACHE_VERSION})
+            reader = _HashingReader(source)
+            batch = []
+            context = ET.iterparse(reader, events=('start', 'end'))
+            _, root = next(context)
+            for event, elem in context:
+                if event == 'end' and elem.tag in ('node', 'way', 'relation'):
+                    batch.append(_pack(elem.tag, elem.attrib) +
+                                 ([_pack(child.tag, child.attrib) for child in elem],))
+                    if len(batch) >= BATCH_SIZE:
+                        _write_batch(out, batch)
+                        batch = []
+                    if elem.tag in tags:
+                        yield elem
+                    root.clear()
+            if batch:
+                _write_batch(out, batch)
+            _write_header(out, {'version': CACHE_VERSION, 'size': st.st_size,
+                                'mtime': st.st_mtime, 'sha1': reader.sha1.hexdigest()})
+        except BaseException:
+            out.close()
+            os.remove(tmp_path)
+            raise
+
+    # os.rename can't replace an existing file on Windows
+    if os.path.exists(cache_path):
+        os.remove(cache_path)
+    os.rename(tmp_path, cache_path)
+
+
+def read_cache(cache_path, tags=('node', 'way', 'relation')):
+    """Yield the cached elements in tags"""
+    with open(cache_path, 'rb', BUFFER_SIZE) as f:
+        _read_header(f)
+        while True:
+            length = f.read(BATCH_LENGTH.size)
+            if not length:
+                break
+            # marshal.loads of the whole batch is several times faster than marshal.load
+            batch = marshal.loads(f.read(BATCH_LENGTH.unpack(length)[0]))
+            for tag, values, extra, children in batch:
+                if tag in tags:
+                    yield CachedElement(tag, values, extra,
+                                        [CachedElement(t, v, x) for t, v, x in children])
+
+
+def iter_elements(osm_file, tags=('node', 'way', 'relation'), cache_path=None):
+    """Yield the elements of osm_file in tags, from its cache when it is still valid"""
+    if cache_path is None:
+        cache_path = cache_path_for(osm_file)
+    if is_valid(osm_file, cache_path):
+        return read_cache(cache_path, tags)
+    return build_cache(osm_file, cache_path, tags)
+
+
+def test():
+    import time
+    for _ in range(2):
+        label = "cache" if is_valid(OSMFILE) else "parse"
+        start = time.time()
+        count = sum(1 for _ in iter_elements(OSMFILE))
+        print label, count, "elements in {0:.2f}s".format(time.time() - start)
+
+
+if __name__ == '__main__':
+    test()
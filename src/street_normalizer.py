@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+- Normalizing street types with a token trie built once from the 'mapping' and 'expected'
+    tables, instead of running street_type_re and re.sub on every street name.
+
+- The trie is keyed by the tokens of each street type read from right to left, so it also
+    matches multi-token abbreviations. A single right-to-left scan over the tokens of a name
+    skips trailing unit numbers ("Blvd Ste 100") and directionals ("Rd N") until the longest
+    known street type ends in front of them.
+
+- The test function compares the throughput with update_name from audit_street_name.py.
+"""
+from collections import defaultdict
+import time
+
+from audit_street_name import OSMFILE, audit, mapping, expected, street_type_re, update_name
+
+# How directional tokens should be changed
+directions = { "N": "North",
+               "N.": "North",
+               "S": "South",
+               "S.": "South",
+               "E": "East",
+               "E.": "East",
+               "W": "West",
+               "W.": "West",
+               "NE": "Northeast",
+               "NW": "Northwest",
+               "SE": "Southeast",
+               "SW": "Southwest",
+               "North": "North",
+               "South": "South",
+               "East": "East",
+               "West": "West"
+               }
+
+# Tokens introducing a unit number after the street type, e.g. "Ste 100"
+unit_designators = set(["Ste", "Ste.", "Suite", "Unit", "Apt", "Apt.", "Bldg", "Spc", "#"])
+
+# Marks the end of a street type in the trie (tokens are never None)
+_END = None
+
+
+class StreetNormalizer(object):
+    """Rewrite abbreviated street types and directionals in a single scan per name"""
+
+    def __init__(self, mapping, expected, directions=directions, units=unit_designators):
+        self.directions = directions
+        self.units = units
+        self.expected = set(expected)
+        self._trie = {}
+        for street_type in self.expected:
+            self._add(street_type, street_type)
+        for street_type, better_type in mapping.iteritems():
+            self._add(street_type, better_type)
+
+        # Audit statistics, counted by audit_street_type
+        self.stats = defaultdict(int)
+
+    def _add(self, street_type, better_type):
+        node = self._trie
+        for token in reversed(street_type.split()):
+            node = node.setdefault(token, {})
+        node[_END] = better_type
+
+    def _match(self, tokens, end):
+        """Return (first token, better type) of the longest street type ending at end"""
+        node = self._trie
+        match = None
+        j = end
+        while j > 0:
+            node = node.get(tokens[j - 1])
+            if node is None:
+                break
+            j -= 1
+            if _END in node:
+                match = (j, node[_END])
+        return match
+
+    def scan(self, name):
+        """Return the tokens of name, the street type found and the edits to make
+
+        The street type is None when the name doesn't end in a known type; the edits are
+        (first token, end token, replacement) tuples, right to left, and only made for
+        known types. Directionals after the street type are only spelled out when a base
+        name comes before it, so lettered streets like "Avenue E" are left alone.
+        """
+        tokens = name.split()
+        directionals = []
+
+        # Skip trailing unit numbers and directionals until a known street type ends at i
+        i = len(tokens)
+        match = self._match(tokens, i)
+        while match is None and i > 1:
+            token = tokens[i - 1]
+            if token[0] == '#':
+                i -= 1
+            elif i > 2 and tokens[i - 2] in self.units:
+                i -= 2
+            elif token in self.directions:
+                if self.directions[token] != token:
+                    directionals.append((i - 1, i, self.directions[token]))
+                i -= 1
+            else:
+                break
+            match = self._match(tokens, i)
+
+        if match is None:
+            return tokens, None, []
+
+        start, better_type = match
+        street_type = " ".join(tokens[start:i])
+        edits = directionals if start > 0 else []
+        if better_type != street_type:
+            edits.append((start, i, better_type))
+        return tokens, street_type, edits
+
+    def update_name(self, name):
+        """Return name with its street type and directionals spelled out
+
+        Only the edited tokens are replaced, the whitespace between tokens is kept.
+        """
+        tokens, street_type, edits = self.scan(name)
+        if not edits:
+            return name
+        offsets = []
+        pos = 0
+        for token in tokens:
+            pos = name.index(token, pos)
+            offsets.append(pos)
+            pos += len(token)
+        # Edits were collected right to left, so earlier offsets stay valid
+        for start, end, better in edits:
+            name = name[:offsets[start]] + better + name[offsets[end - 1] + len(tokens[end - 1]):]
+        return name
+
+    def audit_street_type(self, street_types, street_name):
+        """Add unexpected street types to street_types like audit_street_name does"""
+        tokens, street_type, edits = self.scan(street_name)
+        self.stats['names'] += 1
+        if street_type is None:
+            self.stats['unknown'] += 1
+            if tokens:
+                street_types[tokens[-1]].add(street_name)
+        elif street_type in self.expected:
+            self.stats['expected'] += 1
+        else:
+            self.stats['mapped'] += 1
+            street_types[street_type].add(street_name)
+        if edits:
+            self.stats['changed'] += 1
+
+
+# Returning names per second of update_name and of the normalizer over the same names
+def benchmark(names, normalizer, repeat=3):
+    results = {}
+    for label, update in (("regex", lambda name: update_name(name, mapping, street_type_re)),
+                          ("trie", normalizer.update_name)):
+        best = None
+        for _ in range(repeat):
+            start = time.time()
+            for name in names:
+                update(name)
+            elapsed = time.time() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        results[label] = len(names) / best if best else float('inf')
+    return results
+
+
+def test():
+    normalizer = StreetNormalizer(mapping, expected)
+    st_types = audit(OSMFILE)
+    names = [name for ways in st_types.itervalues() for name in ways]
+
+    street_types = defaultdict(set)
+    for name in names:
+        normalizer.audit_street_type(street_types, name)
+        better_name = normalizer.update_name(name)
+        if better_name != name:
+            print name, "=>", better_name
+    print dict(normalizer.stats)
+
+    # Repeat the audited names up to a large list for timing
+    large = (names * (200000 // max(len(names), 1) + 1))[:200000]
+    for label, rate in sorted(benchmark(large, normalizer).items()):
+        print "{0}: {1:.0f} names/s".format(label, rate)
+
+
+if __name__ == '__main__':
+    test()
@@ -1,8 +1,8 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-import xml.etree.cElementTree as ET
 import pprint
 import re
+from osm_cache import iter_elements
 """
 Your task is to explore the data a bit more.
 Before you process the data and add it into your database, you should check the
@@ -48,8 +48,10 @@ def key_type(element, keys):
 
 def process_map(filename):
     keys = {"lower": 0, "lower_colon": 0, "problemchars": 0, "other": 0}
-    for _, element in ET.iterparse(filename):
-        keys = key_type(element, keys)
+    # Every tag is a child of a node, way or relation, which osm_cache keeps parsed
+    for element in iter_elements(filename):
+        for child in element:
+            keys = key_type(child, keys)
 
     return keys
 
@@ -1,8 +1,8 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-import xml.etree.cElementTree as ET
 import pprint
 import re
+from osm_cache import iter_elements
 """
 Your task is to explore the data a bit more.
 The first task is a fun one - find out how many unique users
@@ -22,7 +22,8 @@ def get_user(element):
 
 def process_map(filename):
     users = set()
-    for _, element in ET.iterparse(filename):
+    # Only nodes, ways and relations carry a uid, and osm_cache keeps them parsed
+    for element in iter_elements(filename):
         if element.get("uid"):
             users.add(element.attrib["uid"])
 